@@ -6,20 +6,59 @@ A filter that allows a caching system in the Proxy Server.
 from swift.common.utils import get_logger
 from swift.common.utils import register_swift_info
 from swift.common.utils import cache_from_env
-from swift.common.exceptions import DiskFileXattrNotSupported
+from swift.common.utils import closing_if_possible
+from swift.common.utils import config_true_value
+from swift.common.utils import drop_buffer_cache
+from swift.common.utils import lock_path
 from swift.common.exceptions import DiskFileNoSpace
 from swift.common.exceptions import DiskFileNotExist
-from swift.common.swob import Request, Response
-import xattr
+from swift.common.swob import Request, Response, wsgi_to_bytes
+from collections import OrderedDict, deque
+from urllib.parse import quote
+import threading
+import eventlet
+import time
+import msgpack
 import logging
-import pickle
+import atexit
+import struct
+import hashlib
+import uuid
 import errno
 import os
-import redis
 
+try:
+    import redis
+except ImportError:
+    redis = None
 
-SWIFT_METADATA_KEY = 'user.swift.metadata'
-PICKLE_PROTOCOL = 2
+
+HEADER_MAGIC = b'SWC2'
+HEADER_FORMAT = '<4sI'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+LRU_INDEX_NAME = '.lru.msgpack'
+LRU_QUEUE_SIZE = 4096
+LRU_TOUCH, LRU_ADD, LRU_REMOVE = range(3)
+BODY_KEY_SUFFIX = ':b'
+HEADERS_KEY_SUFFIX = ':h'
+CHUNK_SIZE = 65536
+
+
+class CachedFileIter(object):
+    """
+    Iterates over an open cache file in CHUNK_SIZE pieces, closing the file
+    once the WSGI server is done with the response.
+    """
+
+    def __init__(self, fp, chunk_size=CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        return iter(lambda: self.fp.read(self.chunk_size), b'')
+
+    def close(self):
+        self.fp.close()
 
 
 class CachingMiddleware(object):
@@ -34,30 +73,38 @@ class CachingMiddleware(object):
     def register_info(self):
         register_swift_info('caching')
 
-    def is_object_in_cache(self):
+    def is_object_in_cache(self, env):
         raise NotImplementedError
 
-    def get_cached_object(self):
+    def get_cached_object(self, req, cached):
         raise NotImplementedError
 
-    @property
-    def is_object_prefetch(self):
-        return 'X-Object-Prefetch' in self.req.headers
+    def prefetch_object(self, req):
+        raise NotImplementedError
 
-    def prefetch_object(self):
+    def delete_cached_object(self, req):
         raise NotImplementedError
 
     def __call__(self, env, start_response):
-        self.req = Request(env)
-
-        if self.req.method == 'GET':
-            if self.is_object_in_cache():
-                resp = self.get_cached_object()
+        # Only build a Request when the cache is involved; most requests
+        # are passed through untouched, looking up nothing but self.app.
+        method = env['REQUEST_METHOD']
+
+        # The middleware instance is shared by every greenthread, so all
+        # per request state is passed along instead of stored on it.
+        if method == 'GET':
+            cached = self.is_object_in_cache(env)
+            if cached is not None:
+                resp = self.get_cached_object(Request(env), cached)
                 return resp(env, start_response)
 
-        elif self.req.method == 'POST':
-            if self.is_object_prefetch:
-                resp = self.prefetch_object()
+        elif method == 'POST':
+            mode = env.get('HTTP_X_OBJECT_PREFETCH')
+            if mode == 'True':
+                resp = self.prefetch_object(Request(env))
+                return resp(env, start_response)
+            elif mode == 'False':
+                resp = self.delete_cached_object(Request(env))
                 return resp(env, start_response)
 
         # Pass on to downstream WSGI component
@@ -70,141 +117,619 @@ class CachingMiddlewareDisk(CachingMiddleware):
         super(CachingMiddlewareDisk, self).__init__(app, conf)
 
         self.location = conf['location']
+        self.max_bytes = int(conf.get('max_cache_bytes', 0))
+        self.lru = None
+        self.lru_lock = threading.Lock()
+        self.used_bytes = 0
+        self.lru_rescan_interval = float(conf.get('lru_rescan_interval', 60))
+        self.lru_rescanner = None
+        self.lru_rescanner_stop = threading.Event()
+        self.tmp_reclaim_age = float(conf.get('tmp_reclaim_age', 86400))
+        self.lru_index_path = os.path.join(self.location, LRU_INDEX_NAME)
+        self.lru_writeback = config_true_value(
+            conf.get('lru_writeback', 'false'))
+        self.lru_flush_interval = float(conf.get('lru_flush_interval', 1))
+        self.lru_queue = deque()
+        self.lru_flusher = None
+        self.lru_flusher_stop = threading.Event()
+        self.keep_cache_on_prefetch = config_true_value(
+            conf.get('keep_cache_on_prefetch', 'false'))
+        self.known_dirs = set()
+        self.known_dirs_lock = threading.Lock()
+
+        if self.max_bytes:
+            atexit.register(self.save_lru)
+
+    def load_lru(self):
+        """
+        Builds the LRU index the first time it is needed, from the saved
+        index when there is one and by walking the cache location
+        otherwise. Files written or evicted by other workers are picked up
+        by the background rescans. Must be called with self.lru_lock held.
+        """
+        if self.lru is not None:
+            return
 
-    def read_metadata(self, fd, obj_path):
+        since = time.time()
+        entries = self.read_lru_index()
+        if entries is None:
+            entries = self.walk_cache()
+        self.merge_lru(entries, since)
+
+    def walk_cache(self):
+        """
+        Lists the files actually in the cache location. The walk yields to
+        other greenthreads after every directory, so it never stalls the
+        requests being served by the worker. Temporary files older than
+        tmp_reclaim_age were left by a writer that died, so they are
+        removed instead of escaping max_cache_bytes forever.
+
+        :returns: list of (last use, full path, size) tuples
+        """
+        entries = []
+        reclaim_before = time.time() - self.tmp_reclaim_age
+        for root, _dirs, files in os.walk(self.location):
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                obj_path = os.path.join(root, name)
+                try:
+                    st = os.stat(obj_path)
+                except OSError:
+                    continue
+                if not name.endswith('.tmp'):
+                    entries.append((st.st_mtime, obj_path, st.st_size))
+                elif st.st_mtime < reclaim_before:
+                    self.logger.info('Removing stale temporary file: %s',
+                                     obj_path)
+                    self.remove_cached_file(obj_path)
+            eventlet.sleep(0)
+        return entries
+
+    def read_lru_index(self):
         """
-        Helper function to read the pickled metadata from an object file.
+        Reads the LRU index saved by this or another worker.
 
-        :param fd: file descriptor or filename to load the metadata from
-        :param filename: full path of the file
-        :returns: dictionary of metadata
+        :returns: list of (last use, full path, size) tuples, or None if
+                  there is no valid saved index
         """
-        metadata = ''
-        key = 0
         try:
-            while True:
-                metadata += xattr.getxattr(fd, '%s%s' % (SWIFT_METADATA_KEY,
-                                                         (key or '')))
-                key += 1
-        except (IOError, OSError) as e:
-            if metadata == '':
-                return False
-            for err in 'ENOTSUP', 'EOPNOTSUPP':
-                if hasattr(errno, err) and e.errno == getattr(errno, err):
-                    msg = "Filesystem at %s does not support xattr" % \
-                          obj_path
-                    logging.exception(msg)
-                    raise DiskFileXattrNotSupported(e)
-            if e.errno == errno.ENOENT:
-                raise DiskFileNotExist()
-        return pickle.loads(metadata)
+            with open(self.lru_index_path, 'rb') as f:
+                saved = msgpack.unpackb(f.read(), raw=False)
+            return [(last_used, obj_path, size)
+                    for obj_path, size, last_used in saved]
+        except (IOError, OSError, ValueError, TypeError):
+            return None
+
+    def write_lru_index(self, entries):
+        """
+        Atomically replaces the saved LRU index. Must be called with the
+        lru lock of the cache location held.
 
-    def write_metadata(self, fd, metadata, obj_path, xattr_size=65536):
+        :param entries: iterable of (last use, full path, size) tuples
+        """
+        tmp_path = self.lru_index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(msgpack.packb([[obj_path, size, last_used]
+                                   for last_used, obj_path, size in entries],
+                                  use_bin_type=True))
+        os.rename(tmp_path, self.lru_index_path)
+
+    def merge_lru(self, entries, since):
+        """
+        Replaces the LRU index with the given entries, ordering each one by
+        the latest of its last use in entries and in the current index.
+        Objects used after since are newer than the entries, so they are
+        kept at the end. The entries are merged and sorted before taking
+        self.lru_lock. Must be called with self.lru_lock held when the
+        index is not built yet, and without it otherwise.
+
+        :param entries: list of (last use, full path, size) tuples
+        :param since: timestamp the entries were collected from
+        """
+        building = self.lru is None
+        if building:
+            known = {}
+        else:
+            with self.lru_lock:
+                known = dict((obj_path, last_used) for obj_path,
+                             (_size, last_used) in self.lru.items())
+
+        merged = sorted((max(last_used, known.get(obj_path, 0)),
+                         obj_path, size)
+                        for last_used, obj_path, size in entries)
+        lru = OrderedDict()
+        used_bytes = 0
+        for last_used, obj_path, size in merged:
+            lru[obj_path] = [size, last_used]
+            used_bytes += size
+
+        if building:
+            self.lru = lru
+            self.used_bytes = used_bytes
+            return
+
+        with self.lru_lock:
+            # The index is kept in last use order, so the objects used
+            # while the entries were merged are all at its end
+            recent = []
+            for obj_path in reversed(self.lru):
+                entry = self.lru[obj_path]
+                if entry[1] < since:
+                    break
+                recent.append((obj_path, entry))
+            for obj_path, entry in reversed(recent):
+                old_size, _last_used = lru.pop(obj_path, (0, 0))
+                lru[obj_path] = entry
+                used_bytes += entry[0] - old_size
+            self.lru = lru
+            self.used_bytes = used_bytes
+            self.enforce_lru_limit()
+
+    def rescan_lru(self):
+        """
+        Rebuilds the LRU index from the files actually in the cache
+        location, which may have been written or evicted by other workers,
+        and saves it so the other workers can reload it instead of walking
+        the location again.
         """
-        Helper function to write pickled metadata for an object file.
+        with self.lru_lock:
+            self.load_lru()
+        since = time.time()
+        self.merge_lru(self.walk_cache(), since)
+        with self.lru_lock:
+            entries = [(last_used, obj_path, size) for obj_path,
+                       (size, last_used) in self.lru.items()]
+        try:
+            with lock_path(self.location, name='lru'):
+                self.write_lru_index(entries)
+        except Exception:
+            self.logger.exception('Unable to save the LRU index')
 
-        :param obj_path: full path of the file
-        :param metadata: metadata to write
+    def refresh_lru(self):
+        """
+        Brings the LRU index in line with the cache location. When another
+        worker saved the index within lru_rescan_interval it is reloaded,
+        so only one worker has to walk the location.
+        """
+        with self.lru_lock:
+            self.load_lru()
+        try:
+            saved = os.stat(self.lru_index_path).st_mtime
+        except OSError:
+            saved = 0
+        if time.time() - saved < self.lru_rescan_interval:
+            entries = self.read_lru_index()
+            if entries is not None:
+                self.merge_lru(entries, saved)
+                return
+        self.rescan_lru()
+
+    def save_lru(self):
+        """
+        Persists the LRU index so the next start does not have to walk the
+        cache location. Several workers share the cache location, so the
+        saved index is merged with the one already on disk rather than
+        replacing it.
+        """
+        if self.lru_queue:
+            self.flush_lru()
+        with self.lru_lock:
+            if self.lru is None:
+                return
+            entries = dict((obj_path, (last_used, obj_path, size))
+                           for obj_path, (size, last_used)
+                           in self.lru.items())
+        try:
+            with lock_path(self.location, name='lru'):
+                for entry in self.read_lru_index() or []:
+                    obj_path = entry[1]
+                    if obj_path in entries:
+                        entries[obj_path] = max(entries[obj_path], entry)
+                    elif os.path.exists(obj_path):
+                        entries[obj_path] = entry
+                self.write_lru_index(sorted(entries.values()))
+        except Exception:
+            self.logger.exception('Unable to save the LRU index')
+
+    def touch_lru(self, obj_path):
+        """
+        Marks an object as the most recently used one.
+
+        :param obj_path: full path of the object
+        """
+        self.update_lru(LRU_TOUCH, obj_path)
+
+    def add_to_lru(self, obj_path, size):
+        """
+        Adds a new object to the LRU index and evicts the least recently
+        used objects until the cache fits in max_cache_bytes again.
+
+        :param obj_path: full path of the object
+        :param size: size in bytes of the object
+        """
+        self.update_lru(LRU_ADD, obj_path, size)
+
+    def remove_from_lru(self, obj_path):
+        """
+        Drops an object from the LRU index.
+
+        :param obj_path: full path of the object
+        """
+        self.update_lru(LRU_REMOVE, obj_path)
+
+    def update_lru(self, op, obj_path, size=0):
+        """
+        Applies an update to the LRU index. With lru_writeback enabled the
+        update is only queued, and the index bookkeeping and evictions are
+        done by a background flusher instead of the request.
+
+        :param op: LRU_TOUCH, LRU_ADD or LRU_REMOVE
+        :param obj_path: full path of the object
+        :param size: size in bytes of the object, for LRU_ADD
+        """
+        if not self.max_bytes:
+            return
+
+        if self.lru_rescanner is None and self.lru_rescan_interval > 0:
+            self.start_lru_rescanner()
+
+        if not self.lru_writeback:
+            with self.lru_lock:
+                self.load_lru()
+                self.apply_lru_update(op, obj_path, size)
+                self.enforce_lru_limit()
+            return
+
+        if self.lru is None:
+            # Files written after the index is built must only enter it
+            # through the queue, so build it before queueing anything
+            with self.lru_lock:
+                self.load_lru()
+
+        self.lru_queue.append((op, obj_path, size))
+        if len(self.lru_queue) >= LRU_QUEUE_SIZE:
+            # Flush under pressure rather than let the queue grow
+            self.flush_lru()
+        elif self.lru_flusher is None:
+            self.start_lru_flusher()
+
+    def apply_lru_update(self, op, obj_path, size):
+        """
+        Applies a single update to the LRU index. Must be called with
+        self.lru_lock held.
+        """
+        if op == LRU_TOUCH:
+            if obj_path in self.lru:
+                entry = self.lru.pop(obj_path)
+                entry[1] = time.time()
+                self.lru[obj_path] = entry
+            return
+
+        old_size, _last_used = self.lru.pop(obj_path, (0, 0))
+        self.used_bytes -= old_size
+        if op == LRU_REMOVE:
+            return
+
+        self.lru[obj_path] = [size, time.time()]
+        self.used_bytes += size
+
+    def enforce_lru_limit(self):
+        """
+        Evicts the least recently used objects until the cache fits in
+        max_cache_bytes. Must be called with self.lru_lock held.
+        """
+        while self.used_bytes > self.max_bytes and len(self.lru) > 1:
+            old_path, (old_size, _last_used) = self.lru.popitem(last=False)
+            self.used_bytes -= old_size
+            self.logger.info('Evicting from cache: %s', old_path)
+            self.remove_cached_file(old_path)
+
+    def flush_lru(self):
         """
-        metastr = pickle.dumps(metadata, PICKLE_PROTOCOL)
-        key = 0
-        while metastr:
+        Applies all the queued LRU updates in a single batch.
+        """
+        with self.lru_lock:
+            self.load_lru()
+            while self.lru_queue:
+                self.apply_lru_update(*self.lru_queue.popleft())
+            # Evict once the whole batch is applied, so objects whose
+            # update is still queued are not taken as the oldest ones
+            self.enforce_lru_limit()
+
+    def start_lru_flusher(self):
+        """
+        Starts the background thread that periodically flushes the queued
+        LRU updates.
+        """
+        with self.lru_lock:
+            if self.lru_flusher is not None:
+                return
+            self.lru_flusher = threading.Thread(target=self.run_lru_flusher)
+            self.lru_flusher.daemon = True
+            self.lru_flusher.start()
+
+    def run_lru_flusher(self):
+        # Under the proxy's eventlet patching this thread is a greenthread
+        # and time.sleep() is left unpatched, so it would block the whole
+        # hub. A threading.Event is green under the same patching.
+        while not self.lru_flusher_stop.wait(self.lru_flush_interval):
+            try:
+                self.flush_lru()
+            except Exception:
+                self.logger.exception('Unable to flush the LRU index')
+
+    def start_lru_rescanner(self):
+        """
+        Starts the background thread that periodically brings the LRU index
+        in line with the cache location shared with other workers, so no
+        request ever waits on a walk of the whole location.
+        """
+        with self.lru_lock:
+            if self.lru_rescanner is not None:
+                return
+            self.lru_rescanner = threading.Thread(
+                target=self.run_lru_rescanner)
+            self.lru_rescanner.daemon = True
+            self.lru_rescanner.start()
+
+    def run_lru_rescanner(self):
+        while not self.lru_rescanner_stop.wait(self.lru_rescan_interval):
             try:
-                xattr.setxattr(fd, '%s%s' % (SWIFT_METADATA_KEY, key or ''),
-                               metastr[:xattr_size])
-                metastr = metastr[xattr_size:]
-                key += 1
-            except IOError as e:
-                for err in 'ENOTSUP', 'EOPNOTSUPP':
-                    if hasattr(errno, err) and e.errno == getattr(errno, err):
-                        msg = "Filesystem at %s does not support xattr" % \
-                              obj_path
-                        logging.exception(msg)
-                        raise DiskFileXattrNotSupported(e)
-                if e.errno in (errno.ENOSPC, errno.EDQUOT):
-                    msg = "No space left on device for %s" % obj_path
-                    logging.exception(msg)
-                    raise DiskFileNoSpace()
+                self.refresh_lru()
+            except Exception:
+                self.logger.exception('Unable to rescan the LRU index')
+
+    def ensure_dir(self, dir_path):
+        """
+        Creates a cache directory unless it is already known to exist, so
+        warm prefixes do not cost a stat() per prefetch.
+
+        :param dir_path: full path of the directory
+        """
+        if dir_path in self.known_dirs:
+            return
+        os.makedirs(dir_path, exist_ok=True)
+        with self.known_dirs_lock:
+            self.known_dirs.add(dir_path)
+
+    def remove_cached_file(self, obj_path):
+        """
+        Removes a cached object.
+
+        :param obj_path: full path of the object
+        """
+        try:
+            os.remove(obj_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
                 raise
 
-    def set_object_metadata(self, obj_path, metadata):
+    def read_metadata(self, fd, obj_path):
+        """
+        Helper function to read the metadata header of a cache file. The
+        header is read with pread(), so the descriptor offset is left
+        untouched.
+
+        :param fd: file descriptor of the cache file
+        :param obj_path: full path of the file
+        :returns: tuple of (dictionary of metadata, header length)
+        """
+        header = os.pread(fd, HEADER_SIZE, 0)
+        if len(header) == HEADER_SIZE:
+            magic, meta_len = struct.unpack(HEADER_FORMAT, header)
+            if magic == HEADER_MAGIC:
+                metastr = os.pread(fd, meta_len, HEADER_SIZE)
+                if len(metastr) == meta_len:
+                    try:
+                        lines = metastr.decode('utf-8').split('\r\n')
+                        metadata = dict(line.split(': ', 1)
+                                        for line in lines[1:-1])
+                    except ValueError:
+                        pass
+                    else:
+                        return metadata, HEADER_SIZE + meta_len
+
+        self.logger.error('Invalid cache file header: %s', obj_path)
+        raise DiskFileNotExist()
+
+    def write_metadata(self, fn, path, metadata):
+        """
+        Helper function to write the metadata header of a cache file. The
+        metadata is stored as plain HTTP header lines, preceded by the
+        quoted swift path, since it can not be recovered from the hashed
+        file name.
+
+        :param fn: cache file opened in binary mode, positioned at 0
+        :param path: swift path of the object, as a WSGI string
+        :param metadata: metadata to write
+        :returns: header length
         """
-        Sets the swift metadata to the specified data_file
+        # WSGI paths hold the raw request bytes decoded as latin-1
+        lines = [quote(wsgi_to_bytes(path))]
+        lines.extend('%s: %s' % item for item in metadata.items())
+        metastr = ''.join(line + '\r\n' for line in lines).encode('utf-8')
+        fn.write(struct.pack(HEADER_FORMAT, HEADER_MAGIC, len(metastr)) +
+                 metastr)
+        return HEADER_SIZE + len(metastr)
+
+    def write_object(self, obj_path, path, app_iter, metadata):
+        """
+        Writes an object and its metadata into the cache, as a single file
+        holding the metadata header followed by the body. The body is
+        streamed chunk by chunk, so it is never held in memory as a whole.
+        The file is written with O_DSYNC to a temporary path and renamed
+        into place, so a crash can never leave a torn cache hit.
 
         :param obj_path: full path of the object
+        :param path: swift path of the object
+        :param app_iter: iterable yielding the object body
         :param metadata: Metadata dictionary
+        :returns: size in bytes of the cache file
         """
-        fd = os.open(obj_path, os.O_WRONLY)
-        self.write_metadata(fd, metadata, obj_path)
-        os.close(fd)
+        # Every writer gets its own temporary file, so overlapping
+        # prefetches of one object never share an inode
+        tmp_path = '%s.%d.%s.tmp' % (obj_path, os.getpid(), uuid.uuid4().hex)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | \
+            getattr(os, 'O_DSYNC', 0)
+        try:
+            try:
+                fd = os.open(tmp_path, flags, 0o644)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # The directory was removed after ensure_dir() cached it
+                os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+                fd = os.open(tmp_path, flags, 0o644)
+            with os.fdopen(fd, 'wb') as fn:
+                size = self.write_metadata(fn, path, metadata)
+                with closing_if_possible(app_iter):
+                    for chunk in app_iter:
+                        fn.write(chunk)
+                        size += len(chunk)
+                if not self.keep_cache_on_prefetch:
+                    # The object is cached to be read later, not now, so
+                    # its pages should not evict hotter ones
+                    fn.flush()
+                    drop_buffer_cache(fn.fileno(), 0, size)
+            os.rename(tmp_path, obj_path)
+        except Exception as e:
+            self.remove_cached_file(tmp_path)
+            if getattr(e, 'errno', None) in (errno.ENOSPC, errno.EDQUOT):
+                msg = "No space left on device for %s" % obj_path
+                logging.exception(msg)
+                raise DiskFileNoSpace()
+            raise
+
+        return size
+
+    def get_object_path(self, path):
+        """
+        Maps a swift path to its cache file. Paths are hashed and sharded
+        into two levels of directories, so no directory grows unbounded
+        however many objects are cached.
 
-    def get_object_metadata(self, obj_path):
+        :param path: swift path of the object
+        :returns: full path of the cache file
         """
-        Retrieves the swift metadata of a specified data file
+        name = hashlib.blake2b(path.encode('latin-1'),
+                               digest_size=16).hexdigest()
+        return os.path.join(self.location, name[:2], name[2:4], name)
 
-        :param data_file: full path of the data file
-        :returns: dictionary with all swift metadata
+    def open_cached_file(self, obj_path):
         """
-        fd = os.open(obj_path, os.O_RDONLY)
-        metadata = self.read_metadata(fd, obj_path)
-        os.close(fd)
+        Opens a cached object for reading. O_NOATIME is requested where
+        available to skip the atime update on every hit; it is only allowed
+        for the file owner, so fall back to a plain open on EPERM. The
+        kernel is told the file will be streamed sequentially, so readahead
+        starts right away.
 
-        return metadata
+        :param obj_path: full path of the object
+        :returns: file descriptor
+        """
+        flags = os.O_RDONLY | getattr(os, 'O_NOATIME', 0)
+        try:
+            fd = os.open(obj_path, flags)
+        except OSError as e:
+            if e.errno != errno.EPERM or flags == os.O_RDONLY:
+                raise
+            fd = os.open(obj_path, os.O_RDONLY)
+
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        return fd
 
-    def is_object_in_cache(self):
+    def is_object_in_cache(self, env):
         """
-        Checks if an object is in cache.
-        :return: True/False
+        Checks if an object is in cache by opening it directly, instead of
+        a stat() followed by an open(). A cache file with an unreadable
+        header counts as a miss.
+        :param env: WSGI environment of the request
+        :return: tuple of (object path, open file positioned at the body,
+                 metadata, body size), or None if not in cache
         """
-        obj_path = self.location+self.req.path
-        self.logger.info('Checking in cache: ' + self.req.path)
+        path = env['PATH_INFO']
+        obj_path = self.get_object_path(path)
+        self.logger.info('Checking in cache: %s', path)
 
-        return os.path.isfile(obj_path)
+        try:
+            fd = self.open_cached_file(obj_path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
 
-    def get_cached_object(self):
+        try:
+            metadata, header_len = self.read_metadata(fd, obj_path)
+            size = os.fstat(fd).st_size - header_len
+            # Sendfile based file wrappers start from the descriptor offset,
+            # not from a buffered file position
+            os.lseek(fd, header_len, os.SEEK_SET)
+        except DiskFileNotExist:
+            os.close(fd)
+            return None
+        except Exception:
+            os.close(fd)
+            raise
+
+        return obj_path, os.fdopen(fd, 'rb'), metadata, size
+
+    def get_cached_object(self, req, cached):
         """
         Gets the object from local cache.
+        :param req: swob.Request instance
+        :param cached: hit state returned by is_object_in_cache
         :return: Response object
         """
-        obj_path = self.location+self.req.path
-        self.logger.info('Object %s in cache', self.req.path)
-
-        with open(obj_path, 'r') as f:
-            data = f.read()
+        obj_path, f, metadata, size = cached
+        self.logger.info('Object %s in cache', req.path)
+        try:
+            self.touch_lru(obj_path)
+        except Exception:
+            f.close()
+            raise
+
+        file_wrapper = req.environ.get('wsgi.file_wrapper')
+        if file_wrapper:
+            app_iter = file_wrapper(f, CHUNK_SIZE)
+        else:
+            app_iter = CachedFileIter(f)
 
-        metadata = self.get_object_metadata(obj_path)
-        response = Response(body=data,
+        response = Response(app_iter=app_iter,
                             headers=metadata,
-                            request=self.req)
+                            request=req)
+        response.content_length = size
         return response
 
-    def prefetch_object(self):
-        obj_path = self.location+self.req.path
-        if self.req.headers['X-Object-Prefetch'] == 'True':
-            self.logger.info('Putting into cache '+self.req.path)
-            new_req = self.req.copy_get()
-            new_req.headers['function-enabled'] = False
-            response = new_req.get_response(self.app)
-
-            if response.is_success:
-                if not os.path.exists(os.path.dirname(obj_path)):
-                    print obj_path
-                    os.makedirs(os.path.dirname(obj_path))
-                with open(obj_path, 'w') as fn:
-                    fn.write(response.body)
-                self.set_object_metadata(obj_path, response.headers)
-
-                return Response(body='Prefetched: '+self.req.path+'\n',
-                                request=self.req)
-            else:
-                return Response(body='An error was occurred prefetching: ' +
-                                self.req.path+'\n', request=self.req)
-
-        elif self.req.headers['X-Object-Prefetch'] == 'False':
-            if os.path.isfile(obj_path):
-                os.remove(obj_path)
-            return Response(body='Deleted '+self.req.path+' from cache\n',
-                            request=self.req)
+    def prefetch_object(self, req):
+        obj_path = self.get_object_path(req.path_info)
+        self.logger.info('Putting into cache %s', req.path)
+        new_req = req.copy_get()
+        new_req.headers['function-enabled'] = False
+        response = new_req.get_response(self.app)
+
+        if response.is_success:
+            self.ensure_dir(os.path.dirname(obj_path))
+            app_iter = response.app_iter
+            if app_iter is None:
+                app_iter = [response.body]
+            size = self.write_object(obj_path, req.path_info, app_iter,
+                                     response.headers)
+            self.add_to_lru(obj_path, size)
+
+            return Response(body='Prefetched: '+req.path+'\n',
+                            request=req)
+        else:
+            return Response(body='An error was occurred prefetching: ' +
+                            req.path+'\n', request=req)
+
+    def delete_cached_object(self, req):
+        obj_path = self.get_object_path(req.path_info)
+        self.remove_from_lru(obj_path)
+        self.remove_cached_file(obj_path)
+        return Response(body='Deleted '+req.path+' from cache\n',
+                        request=req)
 
 
 class CachingMiddlewareMemcache(CachingMiddleware):
@@ -213,61 +738,73 @@ class CachingMiddlewareMemcache(CachingMiddleware):
         super(CachingMiddlewareMemcache, self).__init__(app, conf)
         self.memcache = None
 
-    def link_memcache(self):
+    def link_memcache(self, env):
         if not self.memcache:
-            self.memcache = cache_from_env(self.req.environ)
+            self.memcache = cache_from_env(env)
 
-    def is_object_in_cache(self):
+    def is_object_in_cache(self, env):
         """
-        Checks if an object is in memcache. If exists, the object is stored
-        in self.cached_object.
-        :return: True/False
+        Checks if an object is in memcache. Body and headers are stored
+        under two keys on the same server, so both are fetched with a single
+        round trip.
+        :param env: WSGI environment of the request
+        :return: list of [body, headers], or None if not in cache
         """
-        self.link_memcache()
-        self.logger.info('Checking in cache: ' + self.req.path)
-        self.cached_object = self.memcache.get(self.req.path)
-
-        return self.cached_object is not None
-
-    def get_cached_object(self):
+        self.link_memcache(env)
+        path = env['PATH_INFO']
+        self.logger.info('Checking in cache: %s', path)
+        values = self.memcache.get_multi(
+            [path + BODY_KEY_SUFFIX, path + HEADERS_KEY_SUFFIX], path)
+
+        # get_multi returns None when every memcache server failed
+        if not values or None in values:
+            return None
+        return values
+
+    def get_cached_object(self, req, cached):
         """
         Gets the object from memcache.
+        :param req: swob.Request instance
+        :param cached: hit state returned by is_object_in_cache
         :return: Response object
         """
-        self.logger.info('Object %s in cache', self.req.path)
-        cached_obj = pickle.loads(self.cached_object)
-        resp_headers = cached_obj["Headers"]
-        resp_headers['content-length'] = len(cached_obj["Body"])
+        self.logger.info('Object %s in cache', req.path)
+        body, headers = cached
+        resp_headers = msgpack.unpackb(headers, raw=False)
+        resp_headers['content-length'] = len(body)
 
-        response = Response(body=cached_obj["Body"],
+        response = Response(body=body,
                             headers=resp_headers,
-                            request=self.req)
+                            request=req)
         return response
 
-    def prefetch_object(self):
-        self.link_memcache()
-        if self.req.headers['X-Object-Prefetch'] == 'True':
-            self.logger.info('Putting into cache '+self.req.path)
-            new_req = self.req.copy_get()
-            new_req.headers['function-enabled'] = False
-            response = new_req.get_response(self.app)
-
-            cached_obj = {}
-            cached_obj['Body'] = response.body
-            cached_obj["Headers"] = response.headers
-
-            if response.is_success:
-                self.memcache.set(self.req.path, pickle.dumps(cached_obj))
-                return Response(body='Prefetched: '+self.req.path+'\n',
-                                request=self.req)
-            else:
-                return Response(body='An error was occurred prefetcheing: ' +
-                                self.req.path+'\n', request=self.req)
+    def prefetch_object(self, req):
+        self.link_memcache(req.environ)
+        path = req.path_info
+        self.logger.info('Putting into cache %s', req.path)
+        new_req = req.copy_get()
+        new_req.headers['function-enabled'] = False
+        response = new_req.get_response(self.app)
+
+        if response.is_success:
+            headers = msgpack.packb(dict(response.headers),
+                                    use_bin_type=True)
+            self.memcache.set_multi({path + BODY_KEY_SUFFIX: response.body,
+                                     path + HEADERS_KEY_SUFFIX: headers},
+                                    path, serialize=False)
+            return Response(body='Prefetched: '+req.path+'\n',
+                            request=req)
+        else:
+            return Response(body='An error was occurred prefetcheing: ' +
+                            req.path+'\n', request=req)
 
-        elif self.req.headers['X-Object-Prefetch'] == 'False':
-            self.memcache.delete(self.req.path)
-            return Response(body='Deleting '+self.req.path+' from cache\n',
-                            request=self.req)
+    def delete_cached_object(self, req):
+        self.link_memcache(req.environ)
+        path = req.path_info
+        self.memcache.delete(path + BODY_KEY_SUFFIX, server_key=path)
+        self.memcache.delete(path + HEADERS_KEY_SUFFIX, server_key=path)
+        return Response(body='Deleting '+req.path+' from cache\n',
+                        request=req)
 
 
 class CachingMiddlewareRedis(CachingMiddleware):
@@ -275,6 +812,10 @@ class CachingMiddlewareRedis(CachingMiddleware):
     def __init__(self, app, conf):
         super(CachingMiddlewareRedis, self).__init__(app, conf)
 
+        if redis is None:
+            raise ImportError('The redis caching type requires the redis '
+                              'python package')
+
         self.redis_host = conf.get('redis_host', 'controller')
         self.redis_port = conf.get('redis_port', 6379)
         self.redis_db = conf.get('redis_db', 1)
@@ -282,56 +823,69 @@ class CachingMiddlewareRedis(CachingMiddleware):
                                        self.redis_port,
                                        self.redis_db)
 
-    def is_object_in_cache(self):
+    def is_object_in_cache(self, env):
         """
-        Checks if the requested object is in redis
-        :return: True/False
+        Checks if the requested object is in redis. An entry that can not
+        be decoded, such as one written with the old str() headers, counts
+        as a miss and is deleted, so it is prefetched again in this format.
+        :param env: WSGI environment of the request
+        :return: tuple of (body, headers), or None if not in cache
         """
-        self.logger.info('Checking in cache: ' + self.req.path)
+        path = env['PATH_INFO']
+        self.logger.info('Checking in cache: %s', path)
 
-        self.cached_object = self.redis.hgetall(self.req.path)
+        cached = self.redis.hgetall(path)
 
-        if self.cached_object:
-            return True
-        else:
-            return False
-
-    def get_cached_object(self):
+        if not cached:
+            return None
+        try:
+            headers = msgpack.unpackb(cached[b'Headers'], raw=False)
+            body = cached[b'Body']
+        except (KeyError, ValueError):
+            headers = None
+        if not isinstance(headers, dict):
+            self.logger.error('Invalid cached object in redis: %s', path)
+            self.redis.delete(path)
+            return None
+        return body, headers
+
+    def get_cached_object(self, req, cached):
         """
         Gets the object from redis.
+        :param req: swob.Request instance
+        :param cached: hit state returned by is_object_in_cache
         :return: Response object
         """
-        self.logger.info('Object %s in cache', self.req.path)
-        resp_headers = eval(self.cached_object["Headers"])
+        self.logger.info('Object %s in cache', req.path)
+        body, resp_headers = cached
 
-        response = Response(body=self.cached_object["Body"],
+        response = Response(body=body,
                             headers=resp_headers,
-                            request=self.req)
+                            request=req)
         return response
 
-    def prefetch_object(self):
-        if self.req.headers['X-Object-Prefetch'] == 'True':
-            self.logger.info('Putting into cache '+self.req.path)
-            new_req = self.req.copy_get()
-            new_req.headers['function-enabled'] = False
-            response = new_req.get_response(self.app)
+    def prefetch_object(self, req):
+        self.logger.info('Putting into cache %s', req.path)
+        new_req = req.copy_get()
+        new_req.headers['function-enabled'] = False
+        response = new_req.get_response(self.app)
 
+        if response.is_success:
             cached_obj = {}
-            cached_obj['Body'] = response.body
-            cached_obj["Headers"] = response.headers
-
-            if response.is_success:
-                self.redis.hmset(self.req.path, cached_obj)
-                return Response(body='Prefetched: '+self.req.path+'\n',
-                                request=self.req)
-            else:
-                return Response(body='An error was occurred prefetcheing: ' +
-                                self.req.path+'\n', request=self.req)
+            cached_obj[b'Body'] = response.body
+            cached_obj[b'Headers'] = msgpack.packb(dict(response.headers),
+                                                   use_bin_type=True)
+            self.redis.hmset(req.path_info, cached_obj)
+            return Response(body='Prefetched: '+req.path+'\n',
+                            request=req)
+        else:
+            return Response(body='An error was occurred prefetcheing: ' +
+                            req.path+'\n', request=req)
 
-        elif self.req.headers['X-Object-Prefetch'] == 'False':
-            self.redis.delete(self.req.path)
-            return Response(body='Deleting '+self.req.path+' from cache\n',
-                            request=self.req)
+    def delete_cached_object(self, req):
+        self.redis.delete(req.path_info)
+        return Response(body='Deleting '+req.path+' from cache\n',
+                        request=req)
 
 
 def filter_factory(global_conf, **local_conf):
@@ -343,9 +897,12 @@ def filter_factory(global_conf, **local_conf):
 
     def caching_filter(app):
         if conf['type'] == 'disk':
-            return CachingMiddlewareDisk(app, conf)
-        if conf['type'] == 'memcache':
-            return CachingMiddlewareMemcache(app, conf)
-        if conf['type'] == 'redis':
-            return CachingMiddlewareRedis(app, conf)
+            middleware = CachingMiddlewareDisk(app, conf)
+        elif conf['type'] == 'memcache':
+            middleware = CachingMiddlewareMemcache(app, conf)
+        elif conf['type'] == 'redis':
+            middleware = CachingMiddlewareRedis(app, conf)
+        else:
+            raise ValueError('Unknown caching type: %s' % conf['type'])
+        return middleware
     return caching_filter
@@ -0,0 +1,542 @@
+import atexit
+import hashlib
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import msgpack
+from swift.common.swob import Request, Response
+
+import caching
+
+
+BODY = b'x' * 1000
+
+
+def backend(env, start_response):
+    return Response(body=BODY)(env, start_response)
+
+
+class TestDiskLRU(unittest.TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def make_middleware(self, max_objects=0, **conf):
+        conf.setdefault('location', self.location)
+        # Rescans are driven by the tests, not by a background thread
+        conf.setdefault('lru_rescan_interval', 0)
+        if max_objects:
+            conf['max_cache_bytes'] = max_objects * self.file_size()
+        middleware = caching.CachingMiddlewareDisk(backend, conf)
+        atexit.unregister(middleware.save_lru)
+        return middleware
+
+    def file_size(self):
+        if not hasattr(self, '_file_size'):
+            probe = caching.CachingMiddlewareDisk(
+                backend, {'location': tempfile.mkdtemp()})
+            try:
+                self.prefetch(probe, '/v1/a/c/pp')
+                obj_path = probe.get_object_path('/v1/a/c/pp')
+                self._file_size = os.path.getsize(obj_path)
+            finally:
+                shutil.rmtree(probe.location)
+        return self._file_size
+
+    def prefetch(self, middleware, path):
+        req = Request.blank(path, method='POST',
+                            headers={'X-Object-Prefetch': 'True'})
+        resp = req.get_response(middleware)
+        self.assertEqual(resp.status_int, 200)
+
+    def get(self, middleware, path):
+        resp = Request.blank(path).get_response(middleware)
+        resp.body  # consume the app_iter so the cache file is closed
+        return resp
+
+    def cached(self, middleware, *names):
+        return [os.path.exists(middleware.get_object_path('/v1/a/c/' + name))
+                for name in names]
+
+    def cached_files(self):
+        return [os.path.join(root, name)
+                for root, _dirs, files in os.walk(self.location)
+                for name in files if not name.startswith('.')]
+
+    def test_evicts_least_recently_used(self):
+        middleware = self.make_middleware(max_objects=2)
+        self.prefetch(middleware, '/v1/a/c/o0')
+        self.prefetch(middleware, '/v1/a/c/o1')
+        resp = self.get(middleware, '/v1/a/c/o0')
+        self.assertEqual(resp.body, BODY)
+        self.prefetch(middleware, '/v1/a/c/o2')
+
+        self.assertEqual(self.cached(middleware, 'o0', 'o1', 'o2'),
+                         [True, False, True])
+        self.assertEqual(middleware.used_bytes, 2 * self.file_size())
+
+    def test_delete_is_not_counted(self):
+        middleware = self.make_middleware(max_objects=2)
+        self.prefetch(middleware, '/v1/a/c/o0')
+        self.prefetch(middleware, '/v1/a/c/o1')
+        Request.blank('/v1/a/c/o1', method='POST',
+                      headers={'X-Object-Prefetch': 'False'}).get_response(
+                          middleware)
+        self.prefetch(middleware, '/v1/a/c/o2')
+
+        self.assertEqual(self.cached(middleware, 'o0', 'o1', 'o2'),
+                         [True, False, True])
+
+    def test_rebuild_walk_orders_by_mtime(self):
+        writer = self.make_middleware()
+        for name in ('o0', 'o1', 'o2'):
+            self.prefetch(writer, '/v1/a/c/' + name)
+        # o1 is the oldest file, then o0, then o2
+        for mtime, name in ((2000, 'o0'), (1000, 'o1'), (3000, 'o2')):
+            obj_path = writer.get_object_path('/v1/a/c/' + name)
+            os.utime(obj_path, (mtime, mtime))
+
+        middleware = self.make_middleware(max_objects=3)
+        self.prefetch(middleware, '/v1/a/c/o3')
+
+        self.assertEqual(self.cached(middleware, 'o0', 'o1', 'o2', 'o3'),
+                         [True, False, True, True])
+
+    def test_walk_skips_temporary_and_hidden_files(self):
+        middleware = self.make_middleware(max_objects=2)
+        with open(os.path.join(self.location, 'x.1.abc.tmp'), 'wb') as f:
+            f.write(b'y' * 10000)
+        self.prefetch(middleware, '/v1/a/c/o0')
+
+        self.assertNotIn(os.path.join(self.location, 'x.1.abc.tmp'),
+                         middleware.lru)
+        self.assertEqual(middleware.used_bytes, self.file_size())
+
+    def test_walk_removes_stale_temporary_files(self):
+        middleware = self.make_middleware(max_objects=2,
+                                          tmp_reclaim_age=3600)
+        shard = os.path.join(self.location, 'ab', 'cd')
+        os.makedirs(shard)
+        stale = os.path.join(shard, 'abcd.1.dead.tmp')
+        fresh = os.path.join(shard, 'abcd.2.live.tmp')
+        for tmp_path in (stale, fresh):
+            with open(tmp_path, 'wb') as f:
+                f.write(b'y' * 10000)
+        os.utime(stale, (1000, 1000))
+        self.prefetch(middleware, '/v1/a/c/o0')
+
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(fresh))
+        self.assertEqual(middleware.used_bytes, self.file_size())
+
+    def test_saved_index_orders_but_does_not_hide_files(self):
+        first = self.make_middleware(max_objects=10)
+        self.prefetch(first, '/v1/a/c/o0')
+        self.prefetch(first, '/v1/a/c/o1')
+        for name in ('o0', 'o1'):
+            obj_path = first.get_object_path('/v1/a/c/' + name)
+            os.utime(obj_path, (1000, 1000))
+        self.get(first, '/v1/a/c/o0')
+        first.save_lru()
+
+        # Written by another worker, so it is missing from the index
+        other = self.make_middleware()
+        self.prefetch(other, '/v1/a/c/o2')
+        obj_path = other.get_object_path('/v1/a/c/o2')
+        os.utime(obj_path, (500, 500))
+
+        # o1 goes before o0 because the saved index remembers o0 was read
+        middleware = self.make_middleware(max_objects=2)
+        self.prefetch(middleware, '/v1/a/c/o3')
+        self.assertEqual(self.cached(middleware, 'o0', 'o1', 'o2', 'o3'),
+                         [True, False, True, True])
+
+        # o2 is tracked by the next rescan although it was not saved
+        middleware.rescan_lru()
+        self.assertEqual(self.cached(middleware, 'o0', 'o1', 'o2', 'o3'),
+                         [True, False, False, True])
+
+    def test_save_merges_other_workers(self):
+        first = self.make_middleware(max_objects=10)
+        second = self.make_middleware(max_objects=10)
+        self.prefetch(second, '/v1/a/c/o1')
+        self.prefetch(first, '/v1/a/c/o0')
+        first.save_lru()
+        second.save_lru()
+
+        with open(first.lru_index_path, 'rb') as f:
+            saved = msgpack.unpackb(f.read(), raw=False)
+        self.assertEqual(sorted(entry[0] for entry in saved), sorted([
+            first.get_object_path('/v1/a/c/o0'),
+            first.get_object_path('/v1/a/c/o1')]))
+
+    def test_limit_is_shared_between_workers(self):
+        workers = [self.make_middleware(max_objects=3) for _ in range(4)]
+        for i in range(12):
+            self.prefetch(workers[i % 4], '/v1/a/c/p%x' % i)
+        self.assertGreater(len(self.cached_files()), 3)
+
+        workers[0].rescan_lru()
+
+        files = self.cached_files()
+        self.assertEqual(len(files), 3)
+        self.assertLessEqual(sum(os.path.getsize(p) for p in files),
+                             3 * self.file_size())
+
+    def test_hits_never_walk_the_location(self):
+        middleware = self.make_middleware(max_objects=2)
+        self.prefetch(middleware, '/v1/a/c/o0')
+        with mock.patch('os.walk', side_effect=AssertionError):
+            self.assertEqual(self.get(middleware, '/v1/a/c/o0').body, BODY)
+            self.prefetch(middleware, '/v1/a/c/o1')
+
+    def test_refresh_reloads_an_index_saved_by_another_worker(self):
+        other = self.make_middleware(max_objects=10)
+        self.prefetch(other, '/v1/a/c/o0')
+        middleware = self.make_middleware(max_objects=10)
+        self.prefetch(middleware, '/v1/a/c/o1')
+        self.prefetch(other, '/v1/a/c/o2')
+        other.rescan_lru()
+
+        middleware.lru_rescan_interval = 60
+        with mock.patch('os.walk', side_effect=AssertionError):
+            middleware.refresh_lru()
+        self.assertEqual(sorted(middleware.lru), sorted(
+            middleware.get_object_path('/v1/a/c/' + name)
+            for name in ('o0', 'o1', 'o2')))
+
+    def test_writeback_evicts_after_flush(self):
+        middleware = self.make_middleware(max_objects=2, lru_writeback='true',
+                                          lru_flush_interval=3600)
+        for name in ('o0', 'o1', 'o2', 'o3'):
+            self.prefetch(middleware, '/v1/a/c/' + name)
+        self.assertEqual(len(self.cached_files()), 4)
+
+        middleware.flush_lru()
+        self.assertEqual(self.cached(middleware, 'o0', 'o1', 'o2', 'o3'),
+                         [False, False, True, True])
+
+
+class TestDiskCacheHit(unittest.TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.middleware = caching.CachingMiddlewareDisk(
+            backend, {'location': self.location})
+        req = Request.blank('/v1/a/c/o', method='POST',
+                            headers={'X-Object-Prefetch': 'True'})
+        self.assertEqual(req.get_response(self.middleware).status_int, 200)
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_file_wrapper_starts_at_body(self):
+        offsets = []
+
+        def file_wrapper(f, block_size):
+            # What a sendfile based wrapper would send from
+            offsets.append(os.lseek(f.fileno(), 0, os.SEEK_CUR))
+            return caching.CachedFileIter(f, block_size)
+
+        req = Request.blank('/v1/a/c/o',
+                            environ={'wsgi.file_wrapper': file_wrapper})
+        resp = req.get_response(self.middleware)
+        self.assertEqual(resp.body, BODY)
+        self.assertEqual(resp.content_length, len(BODY))
+
+        obj_path = self.middleware.get_object_path('/v1/a/c/o')
+        self.assertEqual(offsets,
+                         [os.path.getsize(obj_path) - len(BODY)])
+
+    def test_interleaved_hits_keep_their_own_state(self):
+        req = Request.blank('/v1/a/c/o2', method='POST',
+                            headers={'X-Object-Prefetch': 'True'})
+        req.get_response(self.middleware)
+        o2_path = self.middleware.get_object_path('/v1/a/c/o2')
+        with open(o2_path, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'y')
+
+        # A lookup of another object lands while the first one waits
+        first = Request.blank('/v1/a/c/o')
+        second = Request.blank('/v1/a/c/o2')
+        first_hit = self.middleware.is_object_in_cache(first.environ)
+        second_hit = self.middleware.is_object_in_cache(second.environ)
+
+        resp = self.middleware.get_cached_object(first, first_hit)
+        self.assertEqual(resp.body, BODY)
+        resp = self.middleware.get_cached_object(second, second_hit)
+        self.assertEqual(resp.body, BODY[:-1] + b'y')
+
+    def test_filter_factory_returns_the_middleware(self):
+        app = caching.filter_factory({}, type='disk',
+                                     location=self.location)(backend)
+        self.assertIsInstance(app, caching.CachingMiddlewareDisk)
+        self.assertIs(app.app, backend)
+
+    def test_invalid_header_is_a_miss(self):
+        obj_path = self.middleware.get_object_path('/v1/a/c/o')
+        with open(obj_path, 'wb') as f:
+            f.write(b'garbage')
+
+        calls = []
+
+        def counting_backend(env, start_response):
+            calls.append(env['PATH_INFO'])
+            return backend(env, start_response)
+
+        self.middleware.app = counting_backend
+        resp = Request.blank('/v1/a/c/o').get_response(self.middleware)
+        self.assertEqual(resp.body, BODY)
+        self.assertEqual(calls, ['/v1/a/c/o'])
+
+
+class TestMemcacheMiss(unittest.TestCase):
+
+    def test_failed_get_multi_is_a_miss(self):
+        class DownMemcache(object):
+            def get_multi(self, keys, server_key):
+                # What MemcacheRing returns when every server failed
+                return None
+
+        middleware = caching.CachingMiddlewareMemcache(backend, {})
+        middleware.memcache = DownMemcache()
+        resp = Request.blank('/v1/a/c/o').get_response(middleware)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.body, BODY)
+
+
+class TestDiskMetadata(unittest.TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.middleware = caching.CachingMiddlewareDisk(
+            backend, {'location': self.location})
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def stored_path(self, path):
+        with open(self.middleware.get_object_path(path), 'rb') as f:
+            _magic, meta_len = struct.unpack(caching.HEADER_FORMAT,
+                                             f.read(caching.HEADER_SIZE))
+            return f.read(meta_len).decode('utf-8').split('\r\n')[0]
+
+    def test_stored_path_is_quoted_once(self):
+        req = Request.blank('/v1/a/c/%C3%A9', method='POST',
+                            headers={'X-Object-Prefetch': 'True'})
+        self.assertEqual(req.get_response(self.middleware).status_int, 200)
+
+        self.assertEqual(self.stored_path(req.path_info), '/v1/a/c/%C3%A9')
+
+    def round_trip(self, metadata):
+        obj_path = os.path.join(self.location, 'o')
+        with open(obj_path, 'wb') as f:
+            header_len = self.middleware.write_metadata(f, '/v1/a/c/o',
+                                                        metadata)
+            f.write(BODY)
+        fd = os.open(obj_path, os.O_RDONLY)
+        try:
+            read, read_len = self.middleware.read_metadata(fd, obj_path)
+        finally:
+            os.close(fd)
+        self.assertEqual(read_len, header_len)
+        return read
+
+    def test_headers_round_trip(self):
+        metadata = {
+            'Content-Type': 'text/plain',
+            'X-Object-Meta-Empty': '',
+            'X-Object-Meta-Colon': 'a: b: c',
+            # Non ASCII values are WSGI strings of their UTF-8 bytes
+            'X-Object-Meta-Name': '\xc3\xa9t\xc3\xa9',
+        }
+        self.assertEqual(self.round_trip(metadata), metadata)
+
+    def test_no_headers_round_trip(self):
+        self.assertEqual(self.round_trip({}), {})
+
+    def test_hit_serves_stored_headers(self):
+        def meta_backend(env, start_response):
+            return Response(body=BODY, headers={
+                'X-Object-Meta-Colon': 'a: b',
+                'X-Object-Meta-Name': '\xc3\xa9'})(env, start_response)
+
+        self.middleware.app = meta_backend
+        req = Request.blank('/v1/a/c/o', method='POST',
+                            headers={'X-Object-Prefetch': 'True'})
+        req.get_response(self.middleware)
+
+        resp = Request.blank('/v1/a/c/o').get_response(self.middleware)
+        self.assertEqual(resp.body, BODY)
+        self.assertEqual(resp.headers['X-Object-Meta-Colon'], 'a: b')
+        self.assertEqual(resp.headers['X-Object-Meta-Name'], '\xc3\xa9')
+
+    def test_prefetch_streams_the_body(self):
+        chunks = [b'a' * caching.CHUNK_SIZE, b'b' * 10, b'c']
+        closed = []
+        written = []
+        location = self.location
+
+        class BodyIter(object):
+            def __iter__(self):
+                for chunk in chunks:
+                    # Size of the temporary file before each chunk
+                    written.extend(
+                        os.path.getsize(os.path.join(root, name))
+                        for root, _dirs, files in os.walk(location)
+                        for name in files if name.endswith('.tmp'))
+                    yield chunk
+
+            def close(self):
+                closed.append(True)
+
+        def streaming_backend(env, start_response):
+            start_response('200 OK', [
+                ('Content-Length', str(sum(map(len, chunks))))])
+            return BodyIter()
+
+        self.middleware.app = streaming_backend
+        req = Request.blank('/v1/a/c/o', method='POST',
+                            headers={'X-Object-Prefetch': 'True'})
+        self.assertEqual(req.get_response(self.middleware).status_int, 200)
+        self.assertEqual(closed, [True])
+        # The first chunk was on disk before the next one was read
+        self.assertEqual(len(written), 3)
+        self.assertGreater(written[1], caching.CHUNK_SIZE)
+
+        resp = Request.blank('/v1/a/c/o').get_response(self.middleware)
+        self.assertEqual(resp.body, b''.join(chunks))
+
+    def test_object_path_is_sharded(self):
+        obj_path = self.middleware.get_object_path('/v1/a/c/o')
+        name = hashlib.blake2b(b'/v1/a/c/o', digest_size=16).hexdigest()
+        self.assertEqual(obj_path, os.path.join(
+            self.location, name[:2], name[2:4], name))
+
+        req = Request.blank('/v1/a/c/o', method='POST',
+                            headers={'X-Object-Prefetch': 'True'})
+        req.get_response(self.middleware)
+        self.assertEqual(os.listdir(self.location), [name[:2]])
+        self.assertTrue(os.path.isfile(obj_path))
+
+
+class FakeRedis(object):
+
+    def __init__(self, *args):
+        self.data = {}
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def hmset(self, key, mapping):
+        self.data[key] = dict(mapping)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class TestRedis(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(caching.redis, 'StrictRedis', FakeRedis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.calls = []
+
+        def counting_backend(env, start_response):
+            self.calls.append(env['REQUEST_METHOD'])
+            resp = Response(body=BODY, headers={'X-Object-Meta-Foo': 'bar'})
+            return resp(env, start_response)
+
+        self.middleware = caching.CachingMiddlewareRedis(counting_backend,
+                                                         {})
+
+    def test_headers_round_trip(self):
+        req = Request.blank('/v1/a/c/o', method='POST',
+                            headers={'X-Object-Prefetch': 'True'})
+        self.assertEqual(req.get_response(self.middleware).status_int, 200)
+        headers = self.middleware.redis.data['/v1/a/c/o'][b'Headers']
+        self.assertIsInstance(msgpack.unpackb(headers, raw=False), dict)
+
+        resp = Request.blank('/v1/a/c/o').get_response(self.middleware)
+        self.assertEqual(resp.body, BODY)
+        self.assertEqual(resp.headers['X-Object-Meta-Foo'], 'bar')
+        self.assertEqual(self.calls, ['GET'])
+
+    def test_old_format_is_a_miss_and_deleted(self):
+        self.middleware.redis.data['/v1/a/c/o'] = {
+            b'Body': b'old',
+            b'Headers': str({'Content-Length': '3'}).encode('utf-8')}
+
+        resp = Request.blank('/v1/a/c/o').get_response(self.middleware)
+        self.assertEqual(resp.body, BODY)
+        self.assertEqual(self.calls, ['GET'])
+        self.assertNotIn('/v1/a/c/o', self.middleware.redis.data)
+
+    def test_missing_field_is_a_miss(self):
+        self.middleware.redis.data['/v1/a/c/o'] = {b'Body': b'old'}
+
+        resp = Request.blank('/v1/a/c/o').get_response(self.middleware)
+        self.assertEqual(resp.body, BODY)
+        self.assertNotIn('/v1/a/c/o', self.middleware.redis.data)
+
+
+GREEN_FLUSHER_SCRIPT = """
+from swift.common.utils import eventlet_monkey_patch
+eventlet_monkey_patch()
+
+import time
+import eventlet
+from swift.common.swob import Request, Response
+import caching
+
+def backend(env, start_response):
+    return Response(body=b'x')(env, start_response)
+
+middleware = caching.CachingMiddlewareDisk(backend, {
+    'location': %r, 'max_cache_bytes': '1000000',
+    'lru_writeback': 'true', 'lru_flush_interval': '1'})
+Request.blank('/v1/a/c/o', method='POST',
+              headers={'X-Object-Prefetch': 'True'}).get_response(middleware)
+
+# Serve hits for a few flush intervals, as the proxy would
+last = start = time.time()
+max_gap = 0
+while time.time() - start < 2.5:
+    eventlet.sleep(0.01)
+    Request.blank('/v1/a/c/o').get_response(middleware).body
+    now = time.time()
+    max_gap = max(max_gap, now - last)
+    last = now
+print(max_gap)
+"""
+
+
+class TestLRUFlusherGreen(unittest.TestCase):
+
+    def test_requests_are_served_while_flusher_waits(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        try:
+            out = subprocess.check_output(
+                [sys.executable, '-c', GREEN_FLUSHER_SCRIPT % location],
+                cwd=os.path.dirname(os.path.dirname(
+                    os.path.abspath(__file__))),
+                stderr=subprocess.DEVNULL, timeout=15)
+        except subprocess.TimeoutExpired:
+            self.fail('The flusher starved the other greenthreads')
+        self.assertLess(float(out), 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()